@@ -12,29 +12,119 @@
 
 # ## Setup
 #
-# First we import the components we need from `modal`.
+# First we import the components we need from `modal`, along with the standard library modules used below.
+
+import asyncio
+import functools
+import json
+import logging
+from pathlib import Path
+from typing import Optional
 
 from modal import Image, Mount, Secret, Stub, asgi_app, gpu, method
 
+logger = logging.getLogger(__name__)
+
 # Next, we set which model to serve, taking care to specify the GPU configuration required
 # to fit the model into VRAM, and the quantization method (`bitsandbytes` or `gptq`) if desired.
-# Note that quantization does degrade token generation performance significantly.
+#
+# We serve SQLCoder2 quantized to 4-bit NF4 with `bitsandbytes`. Decoding is bound by memory bandwidth, since
+# every generated token reads all of the weights, so 4-bit weights mean roughly 4x fewer bytes per step than
+# FP16. TGI gives the VRAM this frees to the KV cache, so it can batch more requests. The weights are quantized
+# when they are loaded, so the image bakes the original weights at a pinned commit. Drop the `--quantize`
+# flag to serve them in FP16 instead.
 #
 # Any model supported by TGI can be chosen here.
+#
+# The batching flags shape TGI's continuous batcher. SQLCoder2 runs on TGI's flash implementation, which measures
+# free VRAM during warmup and sizes the KV cache (the batch token budget) itself. It ignores
+# `--max-batch-total-tokens`, so we leave that flag out. `--max-batch-prefill-tokens` caps how many prompt tokens
+# are prefilled in one step. `--max-concurrent-requests` is shared with the Modal class below, so Modal never
+# sends a container more inputs than TGI will schedule. Use TGI's `/metrics` endpoint to check the effect,
+# for example with the `tgi_batch_current_size` gauge.
 
 GPU_CONFIG = gpu.A100(memory=40, count=1)
 MODEL_ID = "defog/sqlcoder2"
 REVISION = "4ccba9158b67de83b070a4eb2fadaeb58ab2cd14"
-# Add `["--quantize", "gptq"]` for TheBloke GPTQ models.
+MAX_CONCURRENT_REQUESTS = 128
+STARTUP_TIMEOUT = 300  # seconds to wait for TGI to load the model
+MICRO_BATCH_SIZE = 8  # prompts posted to TGI together by the in-process queue
+GENERATE_MANY_CONCURRENCY = 16  # questions a single `generate_many` call keeps in flight
+# TGI's HTTP router only listens on TCP, so it can't serve over a UNIX domain socket. We bind it to loopback,
+# and the pooled client keeps connections alive, so requests skip the TCP handshake once the pool is warm.
+TGI_HOST = "127.0.0.1"
+TGI_PORT = 8000
 LAUNCH_FLAGS = [
     "--model-id",
     MODEL_ID,
+    "--hostname",
+    TGI_HOST,
     "--port",
-    "8000",
+    str(TGI_PORT),
     "--revision",
     REVISION,
+    "--num-shard",
+    "1",
+    "--quantize",
+    "bitsandbytes-nf4",
+    "--max-input-tokens",
+    "3840",
+    "--max-total-tokens",
+    "4096",
+    "--max-batch-prefill-tokens",
+    "4096",
+    "--max-concurrent-requests",
+    str(MAX_CONCURRENT_REQUESTS),
 ]
 
+# TGI's router and tokenizers size their thread pools to the host's core count by default. On a shared host,
+# those threads compete with the Python process handling inputs, so we cap them. `LOG_LEVEL` drops TGI's
+# per-request info logs but keeps warnings and errors, including shard crash output and CUDA OOMs.
+#
+# TGI's defaults already cover the fused decode paths, so we don't override them. FlashAttention-2 is on for this
+# model, and `USE_FLASH_ATTENTION` can only turn it off. `CUDA_GRAPHS` defaults to batch sizes 1-32 for
+# unquantized and GPTQ/AWQ models. TGI turns CUDA graphs off for `bitsandbytes` quantization, because those
+# kernels can't be captured.
+LAUNCH_ENV = {
+    "TOKIO_WORKER_THREADS": "4",
+    "RAYON_NUM_THREADS": "4",
+    "OMP_NUM_THREADS": "1",
+    "LOG_LEVEL": "warn",
+}
+
+# Parameters sent with every generation request. Only the generated text is used, so we ask TGI to skip
+# per-token details and prefill logprobs, which keeps responses small and cheap to parse.
+#
+# SQLCoder2's answers are usually 30-150 tokens long. The stop sequences end decoding at the closing code fence,
+# or where the model starts a new statement or section, and `max_new_tokens` bounds the worst case.
+# Decode time grows with the number of tokens generated, so shorter generations free room in the batch sooner.
+GENERATE_PARAMETERS = {
+    "max_new_tokens": 256,
+    "stop": ["```", ";\n\n", "### "],
+    "details": False,
+    "decoder_input_details": False,
+    "return_full_text": False,
+}
+
+
+# TGI reports failures as JSON with `error` and `error_type` fields, both as error responses and as events
+# inside a stream. We raise them with TGI's message rather than a bare HTTP status.
+def tgi_error(payload):
+    return RuntimeError(f"TGI {payload.get('error_type', 'error')}: {payload.get('error')}")
+
+
+def raise_for_tgi_error(response):
+    if response.is_success:
+        return
+    try:
+        payload = response.json()
+    except ValueError:
+        payload = {
+            "error_type": f"HTTP {response.status_code}",
+            "error": response.text or response.reason_phrase,
+        }
+    raise tgi_error(payload)
+
 # ## Define a container image
 #
 # We want to create a Modal image which has the Huggingface model cache pre-populated.
@@ -64,6 +154,10 @@ def download_model():
 # We’ll start from a Dockerhub image recommended by TGI, and override the default `ENTRYPOINT` for
 # Modal to run its own which enables seamless serverless deployments.
 #
+# We use TGI 2.x, which adds FlashAttention-2, faster paged KV-cache kernels and CUDA graphs over the 1.0 line.
+# TGI 2.x sizes the prompt limit from the model config, so `LAUNCH_FLAGS` sets `--max-input-tokens` (formerly
+# `--max-input-length`) and `--max-total-tokens` explicitly. This keeps them within `--max-batch-prefill-tokens`.
+#
 # Next we run the download step to pre-populate the image with our model weights.
 #
 # For this step to work on a gated model such as LLaMA 2, the HUGGING_FACE_HUB_TOKEN environment
@@ -73,66 +167,90 @@ def download_model():
 #
 # The key should be `HUGGING_FACE_HUB_TOKEN` and the value should be your access token.
 #
-# Finally, we install the `text-generation` client to interface with TGI's Rust webserver over `localhost`.
-
-print(f"Image: {dir(Image)}")
+# Finally, we install `httpx` to talk to TGI's Rust webserver over `localhost`, and `fastapi` for the
+# streaming web endpoint.
 
 image = (
-    Image.from_registry("ghcr.io/huggingface/text-generation-inference:1.0.3")
+    Image.from_registry("ghcr.io/huggingface/text-generation-inference:2.3.1")
     .dockerfile_commands("ENTRYPOINT []")
     .run_function(download_model, secret=Secret.from_name("huggingface"))
-    .pip_install("text-generation")
+    .pip_install("httpx", "fastapi")
 )
 
-stub = Stub("example-tgi-" + MODEL_ID.split("/")[-1], image=image)
+stub = Stub("example-tgi-sqlcoder2", image=image)
 
 
 # ## The model class
 #
 # The inference function is best represented with Modal's [class syntax](/docs/guide/lifecycle-functions).
 # The class syntax is a special representation for a Modal function which splits logic into two parts:
-# 1. the `__enter__` method, which runs once per container when it starts up, and
+# 1. the `__aenter__` method, which runs once per container when it starts up, and
 # 2. the `@method()` function, which runs per inference request.
 #
+# The class also exposes an `@asgi_app()` web endpoint which proxies TGI's server-sent events
+# straight through to the caller, so streamed tokens never round-trip through Python objects.
+#
 # This means the model is loaded into the GPUs, and the backend for TGI is launched just once when each
 # container starts, and this state is cached for each subsequent invocation of the function.
-# Note that on start-up, we must wait for the Rust webserver to accept connections before considering the
-# container ready.
+# Note that on start-up, we must wait for the Rust webserver to report the model as healthy before
+# considering the container ready. We poll with a short, growing backoff so the container is marked ready
+# soon after TGI is.
 #
 # Here, we also
-# - specify the secret so the `HUGGING_FACE_HUB_TOKEN` environment variable is set
+# - specify the secrets so the `HUGGING_FACE_HUB_TOKEN` and `WEB_AUTH_TOKEN` environment variables are set
 # - specify how many A100s we need per container
-# - specify that each container is allowed to handle up to 10 inputs (i.e. requests) simultaneously
-# - keep idle containers for 10 minutes before spinning down
+# - allow each container to handle as many simultaneous inputs (i.e. requests) as TGI will schedule
+# - keep one container warm at all times, so interactive requests don't pay a cold start
+# - spin down idle containers after 2 minutes, so replicas added for a burst don't hold an A100 for long
+# - mount the default schema from `schema.sql`, so it can change without rebuilding the image
 # - lift the timeout of each request.
 
+SCHEMA_PATH = Path(__file__).parent / "schema.sql"
+REMOTE_SCHEMA_PATH = "/root/schema.sql"
+
 
 @stub.cls(
-    secret=Secret.from_name("huggingface"),
+    secrets=[Secret.from_name("huggingface"), Secret.from_name("sqlcoder-web")],
+    mounts=[Mount.from_local_file(SCHEMA_PATH, remote_path=REMOTE_SCHEMA_PATH)],
     gpu=GPU_CONFIG,
-    allow_concurrent_inputs=10,
-    container_idle_timeout=60 * 10,
+    allow_concurrent_inputs=MAX_CONCURRENT_REQUESTS,
+    container_idle_timeout=60 * 2,
+    keep_warm=1,
     timeout=60 * 60,
 )
 class Model:
-    def __enter__(self):
-        import socket
+    async def __aenter__(self):
+        import os
         import subprocess
         import time
 
-        from text_generation import AsyncClient
+        import httpx
+
+        # Per-request logging is at DEBUG level, so it is skipped in production.
+        logging.basicConfig(level=logging.INFO)
 
         self.launcher = subprocess.Popen(
-            ["text-generation-launcher"] + LAUNCH_FLAGS
+            ["text-generation-launcher"] + LAUNCH_FLAGS,
+            env={**os.environ, **LAUNCH_ENV},
+        )
+        # A single pooled client shared by every input, so concurrent requests reuse keep-alive
+        # connections and reach TGI's batcher together instead of opening a connection each.
+        self.client = httpx.AsyncClient(
+            base_url=f"http://{TGI_HOST}:{TGI_PORT}",
+            limits=httpx.Limits(
+                max_connections=MAX_CONCURRENT_REQUESTS,
+                max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+            ),
+            timeout=httpx.Timeout(60.0, connect=2.0),
         )
-        self.client = AsyncClient("http://127.0.0.1:8000", timeout=60)
 
-        # Poll until webserver at 127.0.0.1:8000 accepts connections before running inputs.
-        def webserver_ready():
+        # Poll TGI's `/health` endpoint until the model is loaded before running inputs.
+        # The port is bound before the model is on the GPU, so an open socket alone isn't enough.
+        async def webserver_ready():
             try:
-                socket.create_connection(("127.0.0.1", 8000), timeout=1).close()
-                return True
-            except (socket.timeout, ConnectionRefusedError):
+                response = await self.client.get("/health", timeout=1.0)
+                return response.status_code == 200
+            except httpx.TransportError:
                 # Check if launcher webserving process has exited.
                 # If so, a connection can never be made.
                 retcode = self.launcher.poll()
@@ -142,33 +260,233 @@ class Model:
                     )
                 return False
 
-        while not webserver_ready():
-            time.sleep(1.0)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        delay = 0.05
+        while not await webserver_ready():
+            if time.monotonic() > deadline:
+                raise RuntimeError(
+                    f"webserver not ready after {STARTUP_TIMEOUT} seconds"
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+        logger.info("Webserver ready!")
+
+        # Load the default schema once and render its prompt block. Requests that omit `metadata` then
+        # build their prompt with one concatenation, with no schema formatting or cache lookup.
+        self.default_metadata = Path(REMOTE_SCHEMA_PATH).read_text()
+        self.default_schema_block = schema_block(self.default_metadata)
+
+        # The first generations on a fresh server pay one-off costs such as kernel autotuning and KV-cache block
+        # allocation. Pay them here, once with a short prompt and once with a full schema prompt, so the first
+        # real request runs at steady-state speed.
+        for warmup_prompt in ("SELECT 1;", self._generate_prompt("How many products are there?", None)):
+            response = await self.client.post(
+                "/generate",
+                json={"inputs": warmup_prompt, "parameters": {"max_new_tokens": 8}},
+            )
+            raise_for_tgi_error(response)
+
+        logger.info("Model warmed up!")
+
+        self._queue = asyncio.Queue()
+        self._in_flight = set()
+        self._drainer = asyncio.create_task(self._drain())
+
+    async def __aexit__(self, _exc_type, _exc_value, _traceback):
+        # Stop the drainer, then cancel every input it hasn't finished, so no `_submit` caller waits forever.
+        self._drainer.cancel()
+        await asyncio.gather(self._drainer, return_exceptions=True)
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+        in_flight = list(self._in_flight)
+        for batch in in_flight:
+            batch.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        await self.client.aclose()
+        self.launcher.terminate()
 
-        print("Webserver ready!")
+    def _generate_prompt(self, question: str, metadata: Optional[str]):
+        if metadata is None:
+            return assemble_prompt(question, self.default_schema_block)
+        return generate_prompt(question, metadata=metadata)
 
-    def __exit__(self, _exc_type, _exc_value, _traceback):
-        self.launcher.terminate()
+    async def _generate_text(self, prompt: str):
+        response = await self.client.post(
+            "/generate",
+            json={"inputs": prompt, "parameters": GENERATE_PARAMETERS},
+        )
+        raise_for_tgi_error(response)
+        return response.json()["generated_text"]
+
+    # Non-streaming generations go through a small in-process queue. The drainer takes up to `MICRO_BATCH_SIZE`
+    # prompts that are already queued, without waiting for more, and posts them together. A burst of inputs then
+    # reaches TGI's queue in one scan and joins the same decode step, and a lone request adds no delay. Each
+    # batch runs in its own task, so a slow generation never holds up the next batch.
+    async def _submit(self, prompt: str):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+
+    async def _drain(self):
+        while True:
+            # Nothing is awaited while a batch is being collected, so cancelling the drainer never drops one.
+            batch = [await self._queue.get()]
+            while len(batch) < MICRO_BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # `gather` schedules the batch right away; keep a reference so it isn't garbage collected.
+            in_flight = asyncio.gather(*(self._resolve(prompt, future) for prompt, future in batch))
+            self._in_flight.add(in_flight)
+            in_flight.add_done_callback(self._in_flight.discard)
+            # If the batch is cancelled before a prompt's `_resolve` starts, cancel that caller's future too.
+            in_flight.add_done_callback(lambda _, batch=batch: self._cancel_futures(batch))
+
+    @staticmethod
+    def _cancel_futures(batch):
+        for _, future in batch:
+            future.cancel()
+
+    async def _resolve(self, prompt: str, future: asyncio.Future):
+        # Skip inputs that were cancelled while queued, and cancel the TGI request if the input is cancelled
+        # mid-generation, so abandoned work doesn't hold a batch slot.
+        if future.done():
+            return
+        request = asyncio.ensure_future(self._generate_text(prompt))
+        future.add_done_callback(lambda _: request.cancel())
+        try:
+            generated_text = await request
+        except asyncio.CancelledError:
+            if not future.done():
+                future.cancel()
+        except Exception as exc:
+            if not future.done():
+                future.set_exception(exc)
+        else:
+            if not future.done():
+                future.set_result(generated_text)
 
     @method()
-    async def generate(self, question: str, metadata: str):
-        print("Generating...")
-        prompt = generate_prompt(question, metadata=metadata)
-        result = await self.client.generate(prompt, max_new_tokens=1024)
+    async def generate(self, question: str, metadata: Optional[str] = None):
+        prompt = self._generate_prompt(question, metadata)
+        generated_text = await self._submit(prompt)
+        logger.debug("Generated %d characters of SQL", len(generated_text))
+        return generated_text
+
+    # For bulk workloads, one call keeps up to `GENERATE_MANY_CONCURRENCY` questions in flight, so TGI's
+    # continuous batcher can schedule them together instead of waiting on one Modal round-trip per question.
+    # The cap keeps a single input from taking every TGI slot or exhausting the client's connection pool.
+    # Each question gets `{"sql": ..., "error": None}` on success, or `{"sql": None, "error": "<message>"}` on
+    # failure, so one failure doesn't lose the other results and the caller still sees TGI's message.
+    @method()
+    async def generate_many(self, questions: list[str], metadata: Optional[str] = None):
+        logger.debug("Generating %d queries...", len(questions))
+        semaphore = asyncio.Semaphore(GENERATE_MANY_CONCURRENCY)
 
-        print("Generated!")
-        print(f"Result: {result.generated_text}")
+        async def generate_one(question):
+            async with semaphore:
+                return await self._submit(self._generate_prompt(question, metadata))
 
-        return result.generated_text
+        results = await asyncio.gather(
+            *(generate_one(question) for question in questions), return_exceptions=True
+        )
+        outputs = []
+        for question, result in zip(questions, results):
+            if isinstance(result, BaseException):
+                logger.warning("Failed to generate SQL for %r: %r", question, result)
+                outputs.append({"sql": None, "error": f"{type(result).__name__}: {result}"})
+            else:
+                outputs.append({"sql": result, "error": None})
+        return outputs
 
     @method()
-    async def generate_stream(self, question: str, metadata: str):
-        prompt = generate_prompt(question, metadata=metadata)
-        async for response in self.client.generate_stream(
-            prompt, max_new_tokens=1024
-        ):
-            if not response.token.special:
-                yield response.token.text
+    async def generate_stream(self, question: str, metadata: Optional[str] = None):
+        prompt = self._generate_prompt(question, metadata)
+        async with self.client.stream(
+            "POST",
+            "/generate_stream",
+            json={"inputs": prompt, "parameters": GENERATE_PARAMETERS},
+        ) as response:
+            if not response.is_success:
+                await response.aread()
+                raise_for_tgi_error(response)
+            # Every event parsed from one network read is yielded together, so under load a single Modal
+            # output carries several tokens instead of one each.
+            pending = ""
+            async for chunk in response.aiter_text():
+                *events, pending = (pending + chunk).split("\n\n")
+                texts = []
+                for event in events:
+                    if event.startswith("data:"):
+                        payload = json.loads(event[len("data:") :])
+                        # TGI reports failures inside the 200 stream as an `error` event.
+                        if "error" in payload:
+                            raise tgi_error(payload)
+                        token = payload["token"]
+                        if not token["special"]:
+                            texts.append(token["text"])
+                if texts:
+                    yield "".join(texts)
+
+    # Streaming over HTTP: the raw SSE bytes from TGI are forwarded as-is, so each event still
+    # carries the `token.special` flag and callers filter special tokens on their side.
+    # The endpoint is public, so callers must send the bearer token stored in the `sqlcoder-web` secret.
+    @asgi_app()
+    def web(self):
+        import hmac
+        import os
+
+        from fastapi import Depends, FastAPI, HTTPException, status
+        from fastapi.responses import Response, StreamingResponse
+        from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+        from pydantic import BaseModel
+        from starlette.background import BackgroundTask
+
+        web_app = FastAPI()
+        auth_scheme = HTTPBearer()
+
+        def check_token(credentials: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+            if not hmac.compare_digest(
+                credentials.credentials.encode(), os.environ["WEB_AUTH_TOKEN"].encode()
+            ):
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Invalid bearer token",
+                    headers={"WWW-Authenticate": "Bearer"},
+                )
+
+        class Query(BaseModel):
+            question: str
+            metadata: Optional[str] = None
+
+        @web_app.post("/generate_stream", dependencies=[Depends(check_token)])
+        async def generate_stream(query: Query):
+            prompt = self._generate_prompt(query.question, query.metadata)
+            request = self.client.build_request(
+                "POST",
+                "/generate_stream",
+                json={"inputs": prompt, "parameters": GENERATE_PARAMETERS},
+            )
+            response = await self.client.send(request, stream=True)
+
+            # Pass TGI's error status and body through rather than streaming them back as a 200.
+            if response.status_code != 200:
+                body = await response.aread()
+                await response.aclose()
+                return Response(
+                    body,
+                    status_code=response.status_code,
+                    media_type=response.headers.get("content-type"),
+                )
+
+            return StreamingResponse(
+                response.aiter_raw(),
+                media_type="text/event-stream",
+                background=BackgroundTask(response.aclose),
+            )
+
+        return web_app
 
 
 # Example prompt template for SQLCoder2    
@@ -189,65 +507,60 @@ Given the database schema, here is the SQL query that answers `{user_question}`:
 ```sql
 """
 
-# Example metadata for SQLCoder2    
-METADATA_DEFAULT = """CREATE TABLE products (
-  product_id INTEGER PRIMARY KEY, -- Unique ID for each product
-  name VARCHAR(50), -- Name of the product
-  price DECIMAL(10,2), -- Price of each unit of the product
-  quantity INTEGER  -- Current quantity in stock
-);
-
-CREATE TABLE customers (
-   customer_id INTEGER PRIMARY KEY, -- Unique ID for each customer
-   name VARCHAR(50), -- Name of the customer
-   address VARCHAR(100) -- Mailing address of the customer
-);
-
-CREATE TABLE salespeople (
-  salesperson_id INTEGER PRIMARY KEY, -- Unique ID for each salesperson 
-  name VARCHAR(50), -- Name of the salesperson
-  region VARCHAR(50) -- Geographic sales region 
-);
-
-CREATE TABLE sales (
-  sale_id INTEGER PRIMARY KEY, -- Unique ID for each sale
-  product_id INTEGER, -- ID of product sold
-  customer_id INTEGER,  -- ID of customer who made purchase
-  salesperson_id INTEGER, -- ID of salesperson who made the sale
-  sale_date DATE, -- Date the sale occurred 
-  quantity INTEGER -- Quantity of product sold
-);
-
-CREATE TABLE product_suppliers (
-  supplier_id INTEGER PRIMARY KEY, -- Unique ID for each supplier
-  product_id INTEGER, -- Product ID supplied
-  supply_price DECIMAL(10,2) -- Unit price charged by supplier
-);
-
--- sales.product_id can be joined with products.product_id
--- sales.customer_id can be joined with customers.customer_id 
--- sales.salesperson_id can be joined with salespeople.salesperson_id
--- product_suppliers.product_id can be joined with products.product_id
-"""
+# The template never changes, so split it around its placeholders once at import time. The question appears
+# twice, before and after the schema, so a prompt is
+# `PROMPT_HEAD + question + PROMPT_MIDDLE + metadata + PROMPT_TAIL + question + PROMPT_END`,
+# and building one is a plain concatenation instead of re-parsing the template with `str.format`.
+def split_prompt_template(prompt_template):
+    head, rest = prompt_template.split("{user_question}", 1)
+    middle, rest = rest.split("{table_metadata_string}", 1)
+    tail, end = rest.split("{user_question}", 1)
+    return head, middle, tail, end
 
-# Generate a prompt for SQLCoder2 based on prompt template and metadata
-def generate_prompt(question, prompt_template=PROMPT_TEMPLATE, metadata=METADATA_DEFAULT):
-    print(f"generate_prompt() Question: {question}") 
-    prompt = prompt_template.format(
-        user_question=question, table_metadata_string=metadata
-    )
-    print(f"generate_prompt() Prompt: {prompt}")
-    return prompt
+
+PROMPT_HEAD, PROMPT_MIDDLE, PROMPT_TAIL, PROMPT_END = split_prompt_template(PROMPT_TEMPLATE)
+
+# Everything between the two questions depends only on the metadata, so it is cached per metadata string.
+# The model class renders the default schema's block once when the container starts. Very large schemas are
+# built fresh each time so the cache doesn't pin them in memory.
+MAX_CACHED_METADATA_LENGTH = 64 * 1024
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_schema_block(metadata):
+    return f"{PROMPT_MIDDLE}{metadata}{PROMPT_TAIL}"
+
+
+def schema_block(metadata):
+    if len(metadata) > MAX_CACHED_METADATA_LENGTH:
+        return f"{PROMPT_MIDDLE}{metadata}{PROMPT_TAIL}"
+    return _cached_schema_block(metadata)
+
+
+def assemble_prompt(question, block):
+    return f"{PROMPT_HEAD}{question}{block}{question}{PROMPT_END}"
+
+
+# Generate a prompt for SQLCoder2 based on prompt template and metadata.
+# Prompts are sent to TGI as text. Its HTTP API has no way to pass pre-tokenized `input_ids`, so the schema
+# can't be tokenized once here and reused. TGI's router tokenizes each prompt itself in its Rust validation
+# workers.
+def generate_prompt(question, prompt_template=PROMPT_TEMPLATE, *, metadata):
+    if prompt_template is not PROMPT_TEMPLATE:
+        return prompt_template.format(
+            user_question=question, table_metadata_string=metadata
+        )
+    return assemble_prompt(question, schema_block(metadata))
 
 
 # ## Run the model
 # We define a [`local_entrypoint`](/docs/guide/apps#entrypoints-for-ephemeral-apps) to invoke
 # our remote function. You can run this script locally with `modal run text_generation_inference.py`.
-# This entrypoint generates a response using an example query and default metadata.
+# This entrypoint generates a response using an example query and the default metadata in `schema.sql`.
 @stub.local_entrypoint()
 def main():
     print("main() started")
-    result =  Model().generate.remote("Do we get more revenue from customers in New York compared to customers in San Francisco? Give me the total revenue for each city, and the difference between the two.", metadata=METADATA_DEFAULT)
+    result =  Model().generate.remote("Do we get more revenue from customers in New York compared to customers in San Francisco? Give me the total revenue for each city, and the difference between the two.")
     print(f"main() result: {result}")
 
 
@@ -265,3 +578,19 @@ def main():
 # >>> f = modal.Function.lookup("example-tgi-sqlcoder2", "Model.generate")
 # >>> result = f.remote("How many salespeople are there?", metadata="(Replace with your own metadata)")
 # ```
+#
+# To generate SQL for many questions in one call, use `Model.generate_many`:
+#
+# ```
+# >>> f = modal.Function.lookup("example-tgi-sqlcoder2", "Model.generate_many")
+# >>> results = f.remote(["How many salespeople are there?", "Which product sells best?"], metadata="...")
+# ```
+#
+# Tokens can also be streamed over HTTP as server-sent events from the web endpoint:
+#
+# ```
+# $ curl -N -X POST "$MODEL_WEB_URL/generate_stream" \
+#     -H "Authorization: Bearer $WEB_AUTH_TOKEN" \
+#     -H "Content-Type: application/json" \
+#     -d '{"question": "How many salespeople are there?"}'
+# ```